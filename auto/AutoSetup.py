@@ -5,9 +5,21 @@ Mostly automated installation for a new CMS + gitolite server.
 """
 
 import getpass
+import glob
+import grp
+import hashlib
+import inspect
+import json
 import os
+import pwd
+import re
+import shlex
+import socket
+import statistics
 import subprocess
 import sys
+import tempfile
+import time
 import requests
 
 
@@ -140,12 +152,14 @@ class Runner():
         Runner.interact = interact
 
     @staticmethod
-    def run_step(user_index, step, num_steps):
+    def run_step(user_index, step, num_steps, capture=False):
         """
         Run a given step (action). The step is a dictionary containing
         the fields "text" and "function", which are the description
         and function to run, respectively. The index and total number
         of steps are given for friendly printing.
+        If capture is True and the step supports checkpoints, capture
+        one after the step succeeds (but not if it was skipped).
 
         Return True if the step succeeded or was skipped,
         and the program should proceed.
@@ -156,6 +170,8 @@ class Runner():
             choice = prompt("Continue?", ["yes", "no", "skip"])
             if choice == "skip":
                 info("[Skipping step %d]" % (user_index,))
+                if capture and step.get("checkpoint"):
+                    warn("[No checkpoint is captured for a skipped step]")
                 return True
             elif choice == "no":
                 fail("[Breaking before step %d]" % (user_index,))
@@ -165,6 +181,8 @@ class Runner():
         success = True
         try:
             success = function()
+            if success and capture and step.get("checkpoint"):
+                success = Checkpoint.capture(user_index, step)
         except Exception as e:
             fail(e)
             success = False
@@ -257,6 +275,316 @@ class Runner():
         return key_output.strip()
 
 
+class Checkpoint():
+    """
+    An object for capturing and restoring filesystem snapshots of the
+    system after expensive steps. Each checkpoint is a tarball of the
+    files that changed since the previous checkpoint, together with a
+    journal (JSON) describing the step and the files it contains.
+    Restoring the checkpoints in order on a fresh machine allows
+    continuing from the step after the last one.
+    """
+
+    @staticmethod
+    def marker_path():
+        """
+        Return the path of the marker file, whose modification time
+        is the start of the delta captured by the next checkpoint.
+        It contains the users and groups that existed at that time.
+        """
+        return os.path.join(checkpoint_dir, ".since")
+
+    @staticmethod
+    def begin():
+        """
+        Start tracking changes, unless a previous run already started
+        and has not captured a checkpoint yet.
+        """
+        if not os.path.isdir(checkpoint_dir):
+            os.makedirs(checkpoint_dir)
+        if not os.path.exists(Checkpoint.marker_path()):
+            Checkpoint.touch_marker()
+
+    @staticmethod
+    def touch_marker():
+        """
+        Set the marker to the current time, and save the current
+        users and groups in it.
+        """
+        with open(Checkpoint.marker_path(), 'w') as f:
+            json.dump(Checkpoint.accounts(), f, indent=4)
+
+    @staticmethod
+    def accounts():
+        """
+        Return the users and groups of this machine, as a dictionary
+        with the fields "users" (name to its passwd fields) and
+        "groups" (name to its gid and members).
+        """
+        users = {user.pw_name: {"uid": user.pw_uid,
+                                "group": grp.getgrgid(user.pw_gid).gr_name,
+                                "comment": user.pw_gecos,
+                                "home": user.pw_dir,
+                                "shell": user.pw_shell}
+                 for user in pwd.getpwall()}
+        groups = {group.gr_name: {"gid": group.gr_gid,
+                                  "members": sorted(group.gr_mem)}
+                  for group in grp.getgrall()}
+        return {"users": users, "groups": groups}
+
+    @staticmethod
+    def new_accounts():
+        """
+        Return the users, groups and group members added since the
+        marker, in the format of accounts. Only new members are listed
+        for groups that existed before.
+        """
+        with open(Checkpoint.marker_path()) as f:
+            before = json.load(f)
+        now = Checkpoint.accounts()
+        users = {name: user for name, user in now["users"].items()
+                 if name not in before["users"]}
+        groups = {}
+        for name, group in now["groups"].items():
+            old_members = before["groups"].get(name, {}).get("members", [])
+            members = [member for member in group["members"]
+                       if member not in old_members]
+            if name not in before["groups"] or members:
+                groups[name] = {"gid": group["gid"], "members": members}
+        return {"users": users, "groups": groups}
+
+    @staticmethod
+    def create_accounts(accounts):
+        """
+        Create the given users and groups (see new_accounts) on this
+        machine, keeping their ids when they are free, so that
+        restored files belong to them.
+        """
+        for name, group in sorted(accounts["groups"].items()):
+            try:
+                grp.getgrnam(name)
+            except KeyError:
+                command = ["sudo", "groupadd", name]
+                try:
+                    grp.getgrgid(group["gid"])
+                except KeyError:
+                    command += ["--gid", str(group["gid"])]
+                run(command)
+
+        for name, user in sorted(accounts["users"].items()):
+            try:
+                pwd.getpwnam(name)
+                continue
+            except KeyError:
+                pass
+            command = ["sudo", "useradd", "--no-create-home",
+                       "--gid", user["group"], "--home-dir", user["home"],
+                       "--shell", user["shell"], "--comment", user["comment"]]
+            try:
+                pwd.getpwuid(user["uid"])
+            except KeyError:
+                command += ["--uid", str(user["uid"])]
+            if user["uid"] < 1000:
+                command.append("--system")
+            run(command + [name])
+
+        for name, group in sorted(accounts["groups"].items()):
+            for member in group["members"]:
+                try:
+                    pwd.getpwnam(member)
+                except KeyError:
+                    warn("[User %s doesn't exist, not adding it to %s]" %
+                         (member, name))
+                    continue
+                run(["sudo", "gpasswd", "--add", member, name])
+
+    @staticmethod
+    def step_keys():
+        """
+        Return a dictionary from 1-based step index to the key of the
+        checkpoint after that step, for every step that supports
+        checkpoints. A key depends on the CMS and isolate branches,
+        on the code of the step (so changing a package list invalidates
+        it), and on the key of the previous checkpoint.
+        """
+        keys = {}
+        previous_key = ""
+        for index, step in enumerate(steps):
+            if not step.get("checkpoint"):
+                continue
+            signature = hashlib.sha1()
+            for part in [previous_key, cms_branch, isolate_branch,
+                         step["text"], inspect.getsource(step["function"])]:
+                signature.update(part.encode())
+                signature.update(b"\0")
+            previous_key = signature.hexdigest()
+            keys[index + 1] = previous_key
+        return keys
+
+    @staticmethod
+    def paths(user_index, key):
+        """
+        Return the tarball and journal paths of a checkpoint.
+        """
+        base = os.path.join(checkpoint_dir,
+                            "step-%02d-%s" % (user_index, key[:12]))
+        return base + ".tar.gz", base + ".json"
+
+    @staticmethod
+    def capture(user_index, step):
+        """
+        Capture a checkpoint after the given step: archive every file
+        and directory under checkpoint_roots that changed since the
+        marker (except checkpoint_excludes), and write the journal next
+        to it, including the users and groups that were added.
+        The inode change time is used, because dpkg and setup.py keep
+        the original modification times of the files they install.
+        Note that deleted files are not recorded.
+        """
+        key = Checkpoint.step_keys()[user_index]
+        tar_path, journal_path = Checkpoint.paths(user_index, key)
+        list_path = os.path.join(checkpoint_dir, "files.txt")
+
+        excludes = ["-path", checkpoint_dir]
+        for pattern in checkpoint_excludes:
+            excludes += ["-o", "-path", pattern]
+        roots = [root for root in checkpoint_roots if os.path.isdir(root)]
+        find_command = ["sudo", "find"] + roots + [
+            "-xdev",
+            "("] + excludes + [")", "-prune", "-o",
+            "-cnewer", Checkpoint.marker_path(),
+            "-print"
+        ]
+
+        # The database files must not change while they are archived.
+        was_active = run_with_io(["systemctl", "is-active", "--quiet",
+                                  "postgresql"], fail_abort=False)[1] == 0
+        if was_active:
+            run(["sudo", "systemctl", "stop", "postgresql"])
+        try:
+            files_text, _ = run_with_io(find_command)
+            files = sorted(path.lstrip("/")
+                           for path in files_text.splitlines())
+            with open(list_path, 'w') as f:
+                f.write("\n".join(files) + "\n")
+
+            info("[Checkpoint of step %d contains %d files]" %
+                 (user_index, len(files)))
+            # Directories are listed so their owners and permissions are
+            # kept, but their contents are only archived if they changed.
+            run(["sudo", "tar", "--create", "--gzip", "--file", tar_path,
+                 "--directory", "/", "--no-recursion",
+                 "--files-from", list_path])
+        finally:
+            if was_active:
+                run(["sudo", "systemctl", "start", "postgresql"])
+        run(["sudo", "chown", getpass.getuser(), tar_path])
+        run(["rm", list_path])
+
+        journal = {
+            "step": user_index,
+            "text": step["text"],
+            "key": key,
+            "cms_branch": cms_branch,
+            "isolate_branch": isolate_branch,
+            "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "accounts": Checkpoint.new_accounts(),
+            "files": files
+        }
+        with open(journal_path, 'w') as f:
+            json.dump(journal, f, indent=4)
+
+        # The next checkpoint only contains what changed from now on.
+        Checkpoint.touch_marker()
+        return True
+
+    @staticmethod
+    def find_restorable():
+        """
+        Return the list of (step index, tarball path, journal path) of the
+        longest chain of existing checkpoints matching the current steps
+        and branches, in order. The chain is empty if nothing matches.
+        """
+        existing = set(glob.glob(os.path.join(checkpoint_dir, "*.json")))
+        chain = []
+        keys = Checkpoint.step_keys()
+        for user_index in sorted(keys):
+            tar_path, journal_path = Checkpoint.paths(user_index,
+                                                      keys[user_index])
+            if journal_path not in existing or not os.path.exists(tar_path):
+                break
+            chain.append((user_index, tar_path, journal_path))
+        return chain
+
+    @staticmethod
+    def verify():
+        """
+        Check that every file of the packages in checkpoint_packages
+        exists after restoring. Return True if nothing is missing.
+        """
+        missing = []
+        for package in checkpoint_packages:
+            output, return_code = run_with_io(["dpkg", "--listfiles",
+                                               package], fail_abort=False)
+            if return_code != 0:
+                fail("[Package %s is not installed]" % package)
+                return False
+            missing += [path for path in output.splitlines()
+                        if path.startswith("/") and
+                        not os.path.lexists(path)]
+        if missing:
+            fail("[%d package files are missing after restoring, "
+                 "for example %s]" % (len(missing), missing[0]))
+            return False
+        return True
+
+    @staticmethod
+    def restore():
+        """
+        Restore the newest matching chain of checkpoints on this machine.
+        Return the 1-based index of the step to continue from,
+        or None if nothing was restored.
+        """
+        chain = Checkpoint.find_restorable()
+        if not chain:
+            warn("[No matching checkpoints in %s]" % checkpoint_dir)
+            return None
+
+        last_index = chain[-1][0]
+        choice = prompt("Restore checkpoints up to step %d (%s) "
+                        "over the root filesystem?" %
+                        (last_index, steps[last_index - 1]["text"]),
+                        ["yes", "no"])
+        if choice != "yes":
+            return None
+
+        # Nothing may write to the database files while they are restored.
+        run(["sudo", "systemctl", "stop", "postgresql"], fail_abort=False)
+
+        for user_index, tar_path, journal_path in chain:
+            info("[Restoring checkpoint of step %d]" % user_index)
+            # Accounts are created first, so files get the right owners.
+            with open(journal_path) as f:
+                journal = json.load(f)
+            Checkpoint.create_accounts(journal.get("accounts", {
+                "users": {}, "groups": {}}))
+            run(["sudo", "tar", "--extract", "--gzip", "--file", tar_path,
+                 "--directory", "/", "--preserve-permissions",
+                 "--same-owner"])
+
+        if not Checkpoint.verify():
+            return None
+
+        # The next steps need the restored services running.
+        run(["sudo", "systemctl", "daemon-reload"])
+        run(["sudo", "systemctl", "start", "postgresql", "nginx"])
+
+        # Continue tracking changes from the restored state.
+        Checkpoint.begin()
+        Checkpoint.touch_marker()
+        return last_index + 1
+
+
 class Installer():
     """
     An object for installation and configuration of components.
@@ -489,6 +817,125 @@ class Installer():
         run(["sudo", "su", "-", "postgres", "-c", commands_str])
         return True
 
+    @staticmethod
+    def load_cms_config():
+        """
+        Return the contents of cms.conf as a dictionary.
+        """
+        Installer.define_cms_dir()
+        conf_path = os.path.join(cms_dir, "config/cms.conf")
+        with open(conf_path) as f:
+            return json.load(f)
+
+    @staticmethod
+    def cms_db_name():
+        """
+        Return the name of the database in cms.conf.
+        """
+        return Installer.load_cms_config()["database"].rsplit("/", 1)[1]
+
+    @staticmethod
+    def create_template_db():
+        """
+        Create a template database, initialized with cmsInitDB and
+        optionally a fixture contest and a users file. CMS databases
+        are then created from it by copying, see reset_db.
+        """
+        conf = Installer.load_cms_config()
+        database = conf["database"].rsplit("/", 1)[0]
+        conf["database"] = "%s/%s" % (database, template_db)
+
+        # A template database can't be dropped, so unmark it first.
+        postgres_commands = [
+            "psql --username=postgres --command=\"UPDATE pg_database "
+            "SET datistemplate=false, datallowconn=true "
+            "WHERE datname='%s'\"" % template_db,
+            "dropdb --username=postgres --if-exists %s" % template_db,
+            "createdb --username=postgres --owner=cmsuser %s "
+            "--encoding='UTF8' --locale='en_US.UTF-8' "
+            "--template=template0" % template_db,
+            "psql --username=postgres --dbname=%s "
+            "--command='ALTER SCHEMA public OWNER TO cmsuser'" % template_db,
+            "psql --username=postgres --dbname=%s "
+            "--command='GRANT SELECT ON pg_largeobject TO cmsuser'" %
+            template_db
+        ]
+        run(["sudo", "su", "-", "postgres", "-c",
+             "&&".join(postgres_commands)])
+
+        # Run the CMS commands with a configuration that points
+        # to the template database. It contains secrets, so it is
+        # created readable only by this user.
+        fd, temp_conf_path = tempfile.mkstemp(suffix=".conf")
+        with os.fdopen(fd, 'w') as f:
+            json.dump(conf, f, indent=4)
+        try:
+            cms_env = ["env", "CMS_CONFIG=" + temp_conf_path]
+            run(cms_env + ["cmsInitDB"])
+            contest_path = str(input("Fixture contest directory to import "
+                                     "into the template (empty for none):"))
+            if contest_path != "":
+                run(cms_env + ["cmsImportContest", "-i", contest_path])
+            users_path = str(input("Users file to import into the template "
+                                   "(empty for none):"))
+            if users_path != "":
+                Installer.import_users(users_path, cms_env)
+        finally:
+            os.remove(temp_conf_path)
+
+        # No connections are allowed, since they would block copying.
+        run(["sudo", "su", "-", "postgres", "-c",
+             "psql --username=postgres --command='ALTER DATABASE %s "
+             "WITH IS_TEMPLATE true ALLOW_CONNECTIONS false'" % template_db])
+        return True
+
+    @staticmethod
+    def import_users(users_path, cms_env):
+        """
+        Add the users listed in the given file with cmsAddUser.
+        Each line contains a username, a password, a first name and
+        a last name, separated by whitespace (the last name may contain
+        spaces). Empty lines and lines starting with # are ignored.
+        """
+        with open(users_path) as f:
+            lines = f.read().splitlines()
+        for line in lines:
+            if line.strip() == "" or line.startswith("#"):
+                continue
+            username, password, first_name, last_name = line.split(None, 3)
+            run(cms_env + ["cmsAddUser", first_name, last_name, username,
+                           "-p", password])
+        return True
+
+    @staticmethod
+    def reset_db(name=None):
+        """
+        Drop the given database (by default the one in cms.conf), and
+        create it again as a copy of the template database. This is much
+        faster than cmsDropDB and cmsInitDB.
+        """
+        if name is None:
+            name = Installer.cms_db_name()
+        if not re.match(r"^[a-z_][a-z0-9_]*$", name):
+            fail("[Invalid database name: %s]" % name)
+            return False
+        if name in [template_db, "postgres", "template0", "template1"]:
+            fail("[Refusing to reset the database %s]" % name)
+            return False
+        choice = prompt("Warning: DROP the database %s and recreate it "
+                        "from %s?" % (name, template_db), ["yes", "no"])
+        if choice != "yes":
+            return False
+
+        postgres_commands = [
+            "dropdb --username=postgres --if-exists %s" % shlex.quote(name),
+            "createdb --username=postgres --owner=cmsuser %s "
+            "--template=%s" % (shlex.quote(name), shlex.quote(template_db))
+        ]
+        run(["sudo", "su", "-", "postgres", "-c",
+             "&&".join(postgres_commands)])
+        return True
+
     @staticmethod
     def customize_cms_config():
         """
@@ -562,39 +1009,249 @@ class Installer():
         run(["sudo", "swapoff", "-a"])
         return True
 
+    @staticmethod
+    def num_workers():
+        """
+        Return the number of Workers defined in cms.conf.
+        """
+        conf = Installer.load_cms_config()
+        return len(conf["core_services"]["Worker"])
+
+    @staticmethod
+    def parse_cpu_list(text):
+        """
+        Parse a kernel CPU list such as "0-2,8" into a list of indices.
+        """
+        cpus = []
+        for part in text.strip().split(","):
+            if "-" in part:
+                first, last = part.split("-")
+                cpus += list(range(int(first), int(last) + 1))
+            elif part != "":
+                cpus.append(int(part))
+        return cpus
+
+    @staticmethod
+    def physical_cores():
+        """
+        Return the CPUs grouped by physical core (hyperthread siblings
+        share a core), as a list of sorted CPU lists, ordered by their
+        first CPU. Without topology information, each CPU is a core.
+        """
+        cores = set()
+        for cpu in range(os.cpu_count()):
+            siblings_path = "/sys/devices/system/cpu/cpu%d/topology/" \
+                            "thread_siblings_list" % cpu
+            try:
+                with open(siblings_path) as f:
+                    siblings = Installer.parse_cpu_list(f.read())
+            except IOError:
+                siblings = [cpu]
+            cores.add(tuple(sorted(siblings)))
+        return sorted(list(core) for core in cores)
+
+    @staticmethod
+    def worker_cpus():
+        """
+        Split the CPUs between the Workers and everything else.
+        One physical core is reserved for each Worker in cms.conf,
+        starting from the last one. The Worker uses the first CPU of its
+        core, and the other hyperthreads of the core stay idle, so
+        nothing shares the core with it. At least one core is left for
+        the other services.
+
+        Return a tuple (shared, reserved) of CPU index lists,
+        where reserved[i] is the CPU of Worker shard i.
+        """
+        num_workers = Installer.num_workers()
+        cores = Installer.physical_cores()
+        if num_workers >= len(cores):
+            raise Exception("[%d Workers need more than %d cores]" %
+                            (num_workers, len(cores)))
+        split = len(cores) - num_workers
+        shared = sorted(cpu for core in cores[:split] for cpu in core)
+        reserved = [core[0] for core in cores[split:]]
+        return shared, reserved
+
+    @staticmethod
+    def timing_variance(cpu, runs=None):
+        """
+        Run a fixed CPU-bound task several times on the given CPU,
+        and return the mean and standard deviation of its duration
+        in seconds.
+        """
+        if runs is None:
+            runs = benchmark_runs
+        code = "import time\n" \
+               "start = time.perf_counter()\n" \
+               "sum(i * i for i in range(2000000))\n" \
+               "print(time.perf_counter() - start)\n"
+        durations = []
+        for _ in range(runs):
+            output, _ = run_with_io(["taskset", "--cpu-list", str(cpu),
+                                     sys.executable, "-c", code])
+            durations.append(float(output))
+        return statistics.mean(durations), statistics.stdev(durations)
+
+    @staticmethod
+    def report_timing_variance(cpu, title):
+        """
+        Print the timing benchmark results of the given CPU.
+        """
+        mean, stddev = Installer.timing_variance(cpu)
+        info("[%s: CPU %d mean %.4fs, stddev %.4fs (%.2f%%)]" %
+             (title, cpu, mean, stddev, 100 * stddev / mean))
+
+    @staticmethod
+    def isolate_worker_cpus():
+        """
+        Reserve one CPU per Worker: the rest of the system (including
+        PostgreSQL, nginx and the other CMS services) is restricted to
+        the shared CPUs with systemd CPUAffinity, each Worker's isolate
+        boxes are restricted to its CPU with a cpuset, and the CPU
+        frequency governor is set to performance where available.
+        The Worker processes themselves are moved to their CPUs with
+        "AutoSetup.py --pin-workers" after CMS is started.
+        """
+        shared, reserved = Installer.worker_cpus()
+        shared_text = " ".join(str(cpu) for cpu in shared)
+        info("[Shared CPUs: %s, Worker CPUs: %s]" %
+             (shared_text, " ".join(str(cpu) for cpu in reserved)))
+        Installer.report_timing_variance(reserved[0], "Before")
+
+        # Everything started by systemd, including login sessions,
+        # inherits this affinity after a reboot.
+        system_conf_dir = "/etc/systemd/system.conf.d"
+        run(["sudo", "mkdir", "-p", system_conf_dir])
+        write(os.path.join(system_conf_dir, "cms-cpus.conf"),
+              "[Manager]\nCPUAffinity=%s\n" % shared_text, sudo=True)
+
+        # Services that should not wait for a reboot.
+        for service in ["postgresql", "nginx"]:
+            drop_in_dir = "/etc/systemd/system/%s.service.d" % service
+            run(["sudo", "mkdir", "-p", drop_in_dir])
+            write(os.path.join(drop_in_dir, "cms-cpus.conf"),
+                  "[Service]\nCPUAffinity=%s\n" % shared_text, sudo=True)
+        run(["sudo", "systemctl", "daemon-reload"])
+        run(["sudo", "systemctl", "restart", "postgresql", "nginx"])
+
+        # The Ubuntu "ondemand" service resets the governor on boot.
+        governors = glob.glob("/sys/devices/system/cpu/cpu*/cpufreq/"
+                              "scaling_governor")
+        if governors:
+            run(["sudo", "systemctl", "disable", "ondemand"],
+                fail_abort=False)
+            for governor_path in governors:
+                write(governor_path, "performance\n", sudo=True)
+        else:
+            warn("[CPU frequency scaling is not available]")
+
+        Installer.restrict_isolate_boxes(reserved)
+
+        info("[Reboot to apply the CPU affinity to all processes, then "
+             "run \"AutoSetup.py --benchmark %d\" to compare, and "
+             "\"AutoSetup.py --pin-workers\" after starting CMS]" %
+             reserved[0])
+        return True
+
+    @staticmethod
+    def restrict_isolate_boxes(reserved):
+        """
+        Restrict the isolate boxes of each Worker to its reserved CPU,
+        in the isolate configuration file. isolate puts every box in
+        its own cpuset cgroup, which overrides any CPU affinity of the
+        Worker, so this is what keeps the sandboxes on their CPU.
+        CMS assigns the boxes 10 * (shard + 1) to 10 * (shard + 1) + 9
+        to each Worker shard.
+        """
+        with open(isolate_config_path) as f:
+            lines = f.read().splitlines()
+
+        # Replace the block written by a previous run, if any.
+        if isolate_config_begin in lines:
+            begin = lines.index(isolate_config_begin)
+            end = lines.index(isolate_config_end)
+            lines = lines[:begin] + lines[end + 1:]
+
+        lines.append(isolate_config_begin)
+        for shard, cpu in enumerate(reserved):
+            for box_id in range(10 * (shard + 1), 10 * (shard + 2)):
+                lines.append("box%d.cpus = %d" % (box_id, cpu))
+        lines.append(isolate_config_end)
+        write(isolate_config_path, "\n".join(lines) + "\n", sudo=True)
+        return True
+
+    @staticmethod
+    def pin_workers():
+        """
+        Move each running Worker (with all its threads) to the CPU
+        reserved for its shard, and keep doing so for Workers that
+        ResourceService restarts, until interrupted.
+        The sandboxes are restricted separately, see
+        restrict_isolate_boxes.
+        """
+        _, reserved = Installer.worker_cpus()
+        pinned = set()
+        info("[Pinning Workers every %d seconds, Ctrl+C to stop]" %
+             pin_interval)
+        try:
+            while True:
+                if not Installer.pin_new_workers(reserved, pinned):
+                    warn("[No running Workers found]")
+                time.sleep(pin_interval)
+        except KeyboardInterrupt:
+            pass
+        return True
+
+    @staticmethod
+    def pin_new_workers(reserved, pinned):
+        """
+        Pin the running Workers whose pid is not in the pinned set,
+        and add them to it. Return whether any Worker is running.
+        """
+        output, _ = run_with_io(["pgrep", "--full", "--list-full",
+                                 "cmsWorker"], fail_abort=False)
+        found = False
+        for line in output.splitlines():
+            # The line is the pid followed by the command line,
+            # in which the shard number is the first numeric argument.
+            parts = line.split()
+            pid = parts[0]
+            shards = [int(arg) for arg in parts[1:] if arg.isdigit()]
+            shard = shards[0] if shards else 0
+            found = True
+            if pid in pinned:
+                continue
+            pinned.add(pid)
+            if shard >= len(reserved):
+                warn("[Worker %d (pid %s) is not in cms.conf]" % (shard, pid))
+                continue
+            run(["sudo", "taskset", "--all-tasks", "--cpu-list",
+                 "--pid", str(reserved[shard]), pid], fail_abort=False)
+        return found
+
     @staticmethod
     def cms_test():
         """
-        Initialize the database, run the CMS test suite, then drop it.
+        Reset the database and run the CMS test suite. The database is
+        left as the tests leave it; the next step resets it again.
         """
         Installer.define_cms_dir()
         Installer.change_to_cms_dir()
 
-        choice = prompt("Warning: init the CMS database?",
-                        ["yes", "no"])
-        if choice == "yes":
-            run(["cmsInitDB"])
-        else:
+        if not Installer.reset_db():
             return False
 
         run(["cmsRunTests"])
-
-        choice = prompt("Warning: DROP the CMS database?",
-                        ["yes", "no"])
-        if choice == "yes":
-            run(["cmsDropDB"])
-        else:
-            return False
-
         return True
 
     @staticmethod
     def cms_init_db():
         """
-        Initialize the CMS database (after it's created).
+        Initialize the CMS database (after it's created),
+        by copying the template database.
         """
-        run(["cmsInitDB"])
-        return True
+        return Installer.reset_db()
 
     @staticmethod
     def cms_add_admin():
@@ -606,6 +1263,61 @@ class Installer():
         run(["cmsAddAdmin", aws_usr, "-p", aws_password])
         return True
 
+    @staticmethod
+    def warm_up_cache(contest_id, concurrency=None):
+        """
+        Fetch every file of the given contest except submissions and
+        user tests (testcases, managers, statements, attachments) from
+        the database into the local cache of each Worker on this host,
+        before the contestants need them, using WarmUpCache.py.
+        Files already in a cache are skipped, and new files appear
+        atomically, so this is safe to run while CMS is running.
+        Workers on other hosts are skipped; run this on each of them.
+
+        Return True if all files were fetched.
+        """
+        if concurrency is None:
+            concurrency = warm_up_concurrency
+        conf = Installer.load_cms_config()
+        shards = []
+        for shard, (host, _) in enumerate(conf["core_services"]["Worker"]):
+            if Installer.is_local_host(host):
+                shards.append(str(shard))
+            else:
+                warn("[Skipping Worker %d on %s, run --warm-up there]" %
+                     (shard, host))
+        if not shards:
+            fail("[No Workers on this host]")
+            return False
+
+        script_path = os.path.join(os.path.dirname(
+            os.path.abspath(__file__)), "WarmUpCache.py")
+        return_code = run(["python2", script_path, str(contest_id),
+                           str(concurrency)] + shards, fail_abort=False)
+        return return_code == 0
+
+    @staticmethod
+    def is_local_host(host):
+        """
+        Return whether the given host name or address is this machine.
+        """
+        if host in ["localhost", socket.gethostname(), socket.getfqdn()]:
+            return True
+        try:
+            address = socket.gethostbyname(host)
+        except socket.error:
+            return False
+        if address.startswith("127."):
+            return True
+        try:
+            local_addresses = socket.gethostbyname_ex(
+                socket.gethostname())[2]
+        except socket.error:
+            local_addresses = []
+        ip_output, _ = run_with_io(["hostname", "--all-ip-addresses"],
+                                   fail_abort=False)
+        return address in local_addresses + ip_output.split()
+
     @staticmethod
     def install_gitolite():
         """
@@ -637,6 +1349,52 @@ cms_dir = None
 instructors_path = os.path.join(home_dir, "for-instructors")
 contestants_path = os.path.join(home_dir, "for-contestants")
 
+# Checkpoints of expensive steps, and the directories they cover.
+checkpoint_dir = os.path.join(home_dir, "checkpoints")
+checkpoint_roots = ["/bin", "/sbin", "/lib", "/lib64", "/etc", "/usr",
+                    "/opt", "/var/lib", home_dir]
+
+# Files that are never captured in checkpoints: the account databases
+# (users and groups are recreated from the journal instead), and state
+# that belongs to the machine rather than to the installation.
+checkpoint_excludes = [
+    "/etc/passwd*",
+    "/etc/shadow*",
+    "/etc/group*",
+    "/etc/gshadow*",
+    "/etc/subuid*",
+    "/etc/subgid*",
+    "/etc/hostname",
+    "/etc/hosts",
+    "/etc/machine-id",
+    "/etc/ssh/ssh_host_*",
+    "/var/lib/dhcp",
+    "/var/lib/cloud",
+    "/var/lib/systemd",
+    "/var/lib/dbus/machine-id",
+]
+
+# Packages whose files are checked after restoring checkpoints.
+checkpoint_packages = ["postgresql-9.5", "nginx-full", "cgroup-lite"]
+
+# Number of repetitions of the timing variance benchmark.
+benchmark_runs = 20
+
+# Seconds between checks for new Workers with --pin-workers.
+pin_interval = 5
+
+# The isolate configuration installed by the CMS prerequisites, and the
+# lines delimiting the per-box CPU settings written by AutoSetup.
+isolate_config_path = "/usr/local/etc/isolate"
+isolate_config_begin = "# Begin AutoSetup Worker CPUs"
+isolate_config_end = "# End AutoSetup Worker CPUs"
+
+# Default number of files fetched concurrently when warming up caches.
+warm_up_concurrency = 4
+
+# Pre-initialized database, from which CMS databases are copied.
+template_db = "cmsdbtemplate"
+
 # Repository information.
 repo_name = "ioi-israel"
 repo_raw_url = "https://raw.githubusercontent.com/ioi-israel/" +\
@@ -662,6 +1420,8 @@ custom_config_files = {
 }
 
 # Installation steps. Each has a description and a corresponding function.
+# Steps marked with "checkpoint" can be captured and restored with
+# the --checkpoint and --restore options.
 steps = [
     {"text": "Installing custom Ubuntu packages",
      "function": Installer.install_custom_ubuntu_deps},
@@ -670,21 +1430,28 @@ steps = [
     {"text": "Downloading custom config files",
      "function": Installer.setup_custom_config},
     {"text": "Installing CMS Ubuntu dependencies",
-     "function": Installer.install_cms_deps},
+     "function": Installer.install_cms_deps,
+     "checkpoint": True},
     {"text": "Cloning CMS",
      "function": Installer.clone_cms},
     {"text": "Running CMS prerequisites",
      "function": Installer.run_cms_prerequisites},
     {"text": "Installing CMS Python dependencies",
-     "function": Installer.install_cms_python_deps},
+     "function": Installer.install_cms_python_deps,
+     "checkpoint": True},
     {"text": "Running CMS setup",
-     "function": Installer.run_cms_setup},
+     "function": Installer.run_cms_setup,
+     "checkpoint": True},
     {"text": "Creating database user",
      "function": Installer.setup_cms_db},
     {"text": "Customizing CMS and server config",
      "function": Installer.customize_cms_config},
+    {"text": "Creating template database",
+     "function": Installer.create_template_db},
     {"text": "Turning off swap",
      "function": Installer.swap_off},
+    {"text": "Reserving CPUs for Workers",
+     "function": Installer.isolate_worker_cpus},
     {"text": "Running CMS tests (may take a while)",
      "function": Installer.cms_test},
     {"text": "Initializing CMS database",
@@ -701,6 +1468,16 @@ def main():
     Run the program by executing the steps sequentially.
     """
     import argparse
+
+    def positive_int(text):
+        """
+        Parse an integer argument that must be at least 1.
+        """
+        value = int(text)
+        if value < 1:
+            raise argparse.ArgumentTypeError("must be at least 1")
+        return value
+
     parser = argparse.ArgumentParser()
     parser.add_argument("-s", "--start",
                         help="step to start with (between 1 and %d)." %
@@ -714,14 +1491,90 @@ def main():
                              "2 confirms steps too (default), "
                              "3 confirms everything",
                         choices=["1", "2", "3"])
+    parser.add_argument("-c", "--checkpoint",
+                        help="capture a checkpoint after each step "
+                             "that supports it (saved in %s)." %
+                             checkpoint_dir,
+                        action="store_true")
+    parser.add_argument("-r", "--restore",
+                        help="restore the newest matching checkpoint "
+                             "and continue from the next step.",
+                        action="store_true")
+    parser.add_argument("--pin-workers",
+                        help="keep the running Workers pinned to their "
+                             "reserved CPUs, until interrupted.",
+                        action="store_true")
+    parser.add_argument("--benchmark",
+                        help="measure the timing variance of the given "
+                             "CPU and exit.",
+                        type=int, metavar="CPU")
+    parser.add_argument("--warm-up",
+                        help="fetch the files of the given contest into "
+                             "the Workers' caches and exit.",
+                        type=int, metavar="CONTEST_ID")
+    parser.add_argument("--warm-up-concurrency",
+                        help="maximum number of files fetched "
+                             "concurrently by --warm-up (default %d)." %
+                             warm_up_concurrency,
+                        type=positive_int, default=warm_up_concurrency)
+    parser.add_argument("--reset-db",
+                        help="drop the given database (default: the one "
+                             "in cms.conf), recreate it from the template "
+                             "database and exit.",
+                        nargs="?", const="", metavar="NAME")
 
     args = parser.parse_args()
     start_range = 0
     end_range = len(steps)
     interact = 2
 
+    if args.restore and args.start is not None:
+        parser.error("[--restore and --start can't be used together]")
+
+    # Set interactivity level.
+    if args.interact is not None:
+        interact = int(args.interact)
+
+    Runner.set_interact(interact)
+
+    # Commands that run instead of the steps.
+    if args.pin_workers:
+        return 0 if Installer.pin_workers() else 1
+    if args.benchmark is not None:
+        if not 0 <= args.benchmark < os.cpu_count():
+            parser.error("[CPU %d doesn't exist, the CPUs are 0 to %d]" %
+                         (args.benchmark, os.cpu_count() - 1))
+        try:
+            Installer.report_timing_variance(args.benchmark, "Benchmark")
+        except Exception as e:
+            fail(e)
+            return 1
+        return 0
+    if args.warm_up is not None:
+        success = Installer.warm_up_cache(args.warm_up,
+                                          args.warm_up_concurrency)
+        return 0 if success else 1
+    if args.reset_db is not None:
+        success = Installer.reset_db(args.reset_db or None)
+        return 0 if success else 1
+
+    # Restore checkpoints and continue after them.
+    if args.restore:
+        try:
+            next_index = Checkpoint.restore()
+        except Exception as e:
+            fail(e)
+            next_index = None
+        if next_index is None:
+            return 1
+        if next_index > len(steps):
+            info("[All steps restored]")
+            return 0
+        start_range = next_index - 1
+        info("[Continuing from step %d]" % next_index)
+
     # Start from a given step. Note indices are 1-based for the user.
-    if args.start is not None:
+    elif args.start is not None:
         start_range = int(args.start) - 1
         if start_range < 0 or start_range >= len(steps):
             parser.error("[Step %d doesn't exist, exiting]" %
@@ -734,15 +1587,13 @@ def main():
     if args.one:
         end_range = start_range + 1
 
-    # Set interactivity level.
-    if args.interact is not None:
-        interact = int(args.interact)
-
-    Runner.set_interact(interact)
+    if args.checkpoint:
+        Checkpoint.begin()
 
     # Run all requested steps, stop on failure.
     for index in range(start_range, end_range):
-        success = Runner.run_step(index + 1, steps[index], len(steps))
+        success = Runner.run_step(index + 1, steps[index], len(steps),
+                                  capture=args.checkpoint)
         if not success:
             return 1
     return 0
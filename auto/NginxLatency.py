@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+
+"""
+Follow the nginx JSON access log (see cms/nginx.conf) and print rolling
+latency percentiles and error rates, per CWS endpoint and per upstream
+CWS instance.
+"""
+
+import calendar
+import collections
+import json
+import math
+import os
+import sys
+import time
+
+
+class Window():
+    """
+    The requests of one bucket in the last few seconds. Old requests
+    are discarded, so memory does not grow with the log.
+    """
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.requests = collections.deque()
+
+    def add(self, timestamp, latency, error):
+        """
+        Record a request, and forget the ones that are now too old.
+        """
+        self.requests.append((timestamp, latency, error))
+        self.expire(timestamp)
+
+    def expire(self, now):
+        """
+        Forget the requests older than the window.
+        """
+        while self.requests and self.requests[0][0] < now - self.seconds:
+            self.requests.popleft()
+
+    def summary(self):
+        """
+        Return a tuple containing the number of requests,
+        the 50th, 95th and 99th latency percentiles,
+        and the error rate.
+        """
+        latencies = sorted(latency for _, latency, _ in self.requests)
+        errors = sum(1 for _, _, error in self.requests if error)
+        count = len(latencies)
+
+        def percentile(fraction):
+            # Nearest rank: the smallest value with at least the given
+            # fraction of the values at or below it.
+            return latencies[max(0, math.ceil(fraction * count) - 1)]
+
+        return (count, percentile(0.5), percentile(0.95), percentile(0.99),
+                errors / count)
+
+
+def parse_line(line):
+    """
+    Parse a log line into a dictionary, or return None if it is invalid.
+    nginx escapes some characters as \\xXX, which is not valid JSON.
+    """
+    line = line.strip()
+    if not line:
+        return None
+    try:
+        return json.loads(line)
+    except ValueError:
+        pass
+    try:
+        return json.loads(line.replace("\\x", "\\u00"))
+    except ValueError:
+        return None
+
+
+def parse_timestamp(value):
+    """
+    Parse an nginx $time_iso8601 value, such as
+    "2017-07-01T10:00:00+03:00", into seconds since the epoch.
+    Return None if it is invalid.
+    """
+    try:
+        local = calendar.timegm(time.strptime(value[:19],
+                                              "%Y-%m-%dT%H:%M:%S"))
+        offset = value[19:]
+        if offset in ("", "Z"):
+            return local
+        sign = -1 if offset[0] == "-" else 1
+        hours, minutes = offset[1:].split(":")
+        return local - sign * (int(hours) * 3600 + int(minutes) * 60)
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_time(value):
+    """
+    Parse an nginx time value in seconds. Return None for "-",
+    which means there is no time (e.g. the upstream was unreachable).
+    """
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def split_upstreams(value):
+    """
+    Split an nginx upstream variable into its values, one per upstream
+    that was tried. nginx separates tries within an upstream group with
+    ", " and different groups (after an internal redirect) with " : ".
+    """
+    return str(value).replace(" : ", ", ").split(", ")
+
+
+def endpoint(method, uri):
+    """
+    Classify a CWS request by its URI.
+    """
+    if uri.startswith("/login") or uri.startswith("/logout"):
+        return "login"
+    if uri.endswith("/submit") and method == "POST":
+        return "submit"
+    if uri.startswith("/notifications"):
+        return "notifications"
+    if uri.startswith("/tasks"):
+        return "tasks"
+    if uri.startswith("/static"):
+        return "static"
+    return "other"
+
+
+def follow(path, from_start, poll_interval, rotation_grace=10):
+    """
+    Yield the lines of the given file as they are written, like
+    "tail -F". Start at the end unless from_start is given.
+    Yield None periodically while there is nothing new.
+    Handle the file being rotated or truncated. After a rotation, the
+    old file is read until nginx starts writing to the new one (or for
+    rotation_grace seconds), so lines flushed late are not lost.
+    """
+    log_file = open(path)
+    if not from_start:
+        log_file.seek(0, os.SEEK_END)
+    inode = os.fstat(log_file.fileno()).st_ino
+    partial = ""
+    rotated_at = None
+
+    while True:
+        line = log_file.readline()
+        if line:
+            # nginx may flush in the middle of a line.
+            if not line.endswith("\n"):
+                partial += line
+                continue
+            yield partial + line
+            partial = ""
+            continue
+
+        yield None
+        time.sleep(poll_interval)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+
+        if stat.st_ino != inode:
+            if rotated_at is None:
+                rotated_at = time.time()
+            if stat.st_size == 0 and \
+                    time.time() - rotated_at < rotation_grace:
+                continue
+            # Finish the old file before switching to the new one.
+            for line in log_file:
+                if not line.endswith("\n"):
+                    partial += line
+                    continue
+                yield partial + line
+                partial = ""
+        elif stat.st_size >= log_file.tell():
+            continue
+
+        log_file.close()
+        log_file = open(path)
+        inode = os.fstat(log_file.fileno()).st_ino
+        partial = ""
+        rotated_at = None
+
+
+def print_report(title, windows):
+    """
+    Print the summary of each non-empty window.
+    """
+    print("%-22s %7s %8s %8s %8s %7s" %
+          (title, "count", "p50", "p95", "p99", "errors"))
+    for name in sorted(windows):
+        if not windows[name].requests:
+            continue
+        count, p50, p95, p99, error_rate = windows[name].summary()
+        print("%-22s %7d %7.3fs %7.3fs %7.3fs %6.2f%%" %
+              (name, count, p50, p95, p99, 100 * error_rate))
+
+
+def main():
+    """
+    Follow the log and print reports periodically.
+    """
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path", nargs="?",
+                        default="/var/log/nginx/access.json.log",
+                        help="the JSON access log (default: %(default)s).")
+    parser.add_argument("-w", "--window", type=float, default=60,
+                        help="seconds of requests in each report "
+                             "(default: %(default)s).")
+    parser.add_argument("-i", "--interval", type=float, default=5,
+                        help="seconds between reports "
+                             "(default: %(default)s).")
+    parser.add_argument("-b", "--beginning", action="store_true",
+                        help="read the log from the beginning. Reports "
+                             "show the window before the newest "
+                             "request read so far.")
+    args = parser.parse_args()
+
+    endpoints = collections.defaultdict(lambda: Window(args.window))
+    upstreams = collections.defaultdict(lambda: Window(args.window))
+
+    try:
+        report_loop(args, endpoints, upstreams)
+    except PermissionError:
+        print("Can't read %s. It is readable by the adm group, so run with "
+              "sudo or add this user to adm." % args.path, file=sys.stderr)
+        return 1
+    except OSError as e:
+        print("Can't read %s: %s" % (args.path, e.strerror), file=sys.stderr)
+        return 1
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+def report_loop(args, endpoints, upstreams):
+    """
+    Add the followed requests to the windows and print reports.
+    Requests are placed by the time nginx logged them.
+    """
+    next_report = time.time() + args.interval
+    latest = None
+    for line in follow(args.path, args.beginning, poll_interval=0.2):
+        entry = parse_line(line) if line is not None else None
+        timestamp = None
+        if entry is not None:
+            timestamp = parse_timestamp(entry.get("time"))
+        if timestamp is not None:
+            latest = max(latest or timestamp, timestamp)
+            error = int(entry.get("status", 0)) >= 500
+            request_time = parse_time(entry.get("request_time"))
+            if request_time is not None:
+                name = endpoint(entry.get("method", ""),
+                                entry.get("uri", ""))
+                endpoints[name].add(timestamp, request_time, error)
+
+            # Each upstream that was tried has its own time. All but the
+            # last failed, which is why nginx tried the next one.
+            addresses = split_upstreams(entry.get("upstream_addr", "-"))
+            times = split_upstreams(entry.get("upstream_response_time", "-"))
+            for index, (address, value) in enumerate(zip(addresses, times)):
+                upstream_time = parse_time(value)
+                if address == "-" or upstream_time is None:
+                    continue
+                failed = error or index < len(addresses) - 1
+                upstreams[address].add(timestamp, upstream_time, failed)
+
+        now = time.time()
+        if now < next_report:
+            continue
+        # When following live, the window ends now, so requests that
+        # stop completing (e.g. a hanging CWS) show up as missing.
+        # When replaying, it ends at the newest request read.
+        if args.beginning:
+            if latest is None:
+                continue
+            end = latest
+        else:
+            end = max(latest or now, now)
+        next_report = now + args.interval
+        for window in list(endpoints.values()) + list(upstreams.values()):
+            window.expire(end)
+        print("[%s, last %d seconds]" %
+              (time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(end)),
+               args.window))
+        print_report("endpoint", endpoints)
+        print_report("upstream", upstreams)
+        print()
+        sys.stdout.flush()
+
+if __name__ == "__main__":
+    sys.exit(main())
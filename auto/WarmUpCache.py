@@ -0,0 +1,171 @@
+#!/usr/bin/env python2
+
+"""
+Fetch the files of a contest from the database into the local file
+caches of the given Workers, before the contestants need them.
+Runs with the Python 2 CMS installation; see "AutoSetup.py --warm-up".
+"""
+
+from __future__ import print_function
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+from multiprocessing.pool import ThreadPool
+
+from cms import config
+from cms.db import Contest, FSObject, SessionGen
+
+
+# Results of fetching one file.
+CACHED = "cached"
+FETCHED = "fetched"
+FAILED = "failed"
+
+
+def default_file_mode():
+    """
+    Return the default mode of new files, like the ones the FileCacher
+    writes, instead of the 0600 of mkstemp.
+    """
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+
+class Warmer(object):
+    """
+    An object for copying files from the database into Worker caches.
+    """
+
+    def __init__(self, cache_dirs):
+        self.cache_dirs = cache_dirs
+        self.file_mode = default_file_mode()
+
+        # Temporary files go to the FileCacher's own temporary
+        # directory, never next to the cached files.
+        for cache_dir in cache_dirs:
+            temp_dir = os.path.join(cache_dir, "_temp")
+            if not os.path.isdir(temp_dir):
+                os.makedirs(temp_dir)
+
+    def temp_file(self, cache_dir):
+        """
+        Create a temporary file for the given cache.
+        Return its file descriptor and path.
+        """
+        fd, temp_path = tempfile.mkstemp(dir=os.path.join(cache_dir,
+                                                          "_temp"))
+        os.fchmod(fd, self.file_mode)
+        return fd, temp_path
+
+    def fetch_to_caches(self, digest, missing):
+        """
+        Copy the given file from the database into the given caches.
+        Return the number of bytes read from the database.
+        """
+        temp_paths = []
+        try:
+            with SessionGen() as session:
+                fso = FSObject.get_from_digest(digest, session)
+                if fso is None:
+                    raise KeyError("Missing file in the database: %s" %
+                                   digest)
+                fd, temp_path = self.temp_file(missing[0])
+                temp_paths.append(temp_path)
+                with os.fdopen(fd, "wb") as output:
+                    with fso.get_lobject(mode="rb") as lobject:
+                        while True:
+                            data = lobject.read(1 << 20)
+                            if not data:
+                                break
+                            output.write(data)
+            size = os.path.getsize(temp_path)
+            for cache_dir in missing[1:]:
+                fd, copy_path = self.temp_file(cache_dir)
+                os.close(fd)
+                temp_paths.append(copy_path)
+                shutil.copyfile(temp_path, copy_path)
+
+            # Renaming is atomic, so a Worker never sees a partial file.
+            for cache_dir, path in zip(missing, temp_paths):
+                os.rename(path, os.path.join(cache_dir, digest))
+            return size
+        finally:
+            for path in temp_paths:
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def fetch(self, digest):
+        """
+        Fetch the given file into the caches that don't have it.
+        Return a tuple (result, bytes read, bytes written).
+        """
+        missing = [cache_dir for cache_dir in self.cache_dirs
+                   if not os.path.exists(os.path.join(cache_dir, digest))]
+        if not missing:
+            return CACHED, 0, 0
+        try:
+            size = self.fetch_to_caches(digest, missing)
+            return FETCHED, size, size * len(missing)
+        except Exception:
+            print("Failed to fetch %s:" % digest)
+            traceback.print_exc()
+            return FAILED, 0, 0
+
+
+def contest_digests(contest_id):
+    """
+    Return the digests of all the files of the given contest, except
+    submissions and user tests, or None if there is no such contest.
+    """
+    with SessionGen() as session:
+        contest = Contest.get_from_id(contest_id, session)
+        if contest is None:
+            return None
+        return contest.enumerate_files(skip_submissions=True,
+                                       skip_user_tests=True)
+
+
+def main():
+    """
+    Warm up the caches. The arguments are the contest ID, the maximum
+    number of concurrent downloads, and the Worker shards.
+    """
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("contest_id", type=int)
+    parser.add_argument("concurrency", type=int)
+    parser.add_argument("shards", type=int, nargs="+")
+    args = parser.parse_args()
+
+    digests = contest_digests(args.contest_id)
+    if digests is None:
+        print("Contest %d not found." % args.contest_id)
+        return 1
+
+    cache_dirs = [os.path.join(config.cache_dir, "fs-cache-Worker-%d" % shard)
+                  for shard in args.shards]
+    warmer = Warmer(cache_dirs)
+
+    start = time.time()
+    pool = ThreadPool(args.concurrency)
+    results = pool.map(warmer.fetch, sorted(digests))
+    pool.close()
+    elapsed = time.time() - start
+
+    counts = {result: sum(1 for other, _, _ in results if other == result)
+              for result in [CACHED, FETCHED, FAILED]}
+    print("%d files (%d fetched, %d already cached, %d failed), "
+          "%.1f MB read, %.1f MB written, %d Workers, %.1f seconds" %
+          (len(digests), counts[FETCHED], counts[CACHED], counts[FAILED],
+           sum(read for _, read, _ in results) / 1e6,
+           sum(written for _, _, written in results) / 1e6,
+           len(cache_dirs), elapsed))
+    return 1 if counts[FAILED] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())